@@ -0,0 +1,253 @@
+from numba import njit
+import numpy as np
+
+# Numba-compiled random playouts for p2_t3 states.
+#
+# A state is unpacked once into two arrays:
+#   bb:     uint32[20] - the 9 pairs of player 1 and player 2 sub-board bitmasks followed by the won/tied
+#           big board bitmasks of player 1 and player 2 (the first 20 entries of the p2_t3 state tuple).
+#   meta:   uint8[3] - the row and column of the required sub-board (UNCONSTRAINED if any) and the player to move.
+# An action (R, C, r, c) is encoded as the index 9 * (3 * R + C) + 3 * r + c.
+
+UNCONSTRAINED = 255
+
+WINS = np.array([0x007, 0x038, 0x1c0, 0x049, 0x092, 0x124, 0x111, 0x054], dtype=np.uint32)
+
+
+def to_bitboards(state):
+    """ Unpacks a p2_t3 state tuple into the bitboard and metadata arrays used by the compiled functions.
+
+    Args:
+        state:  The state of the game.
+
+    Returns:
+        bb: The sub-board and big board bitmasks.
+        meta: The sub-board constraint and the player to move.
+
+    """
+    bb = np.array(state[:20], dtype=np.uint32)
+    if state[20] is None:
+        meta = np.array((UNCONSTRAINED, UNCONSTRAINED, state[22]), dtype=np.uint8)
+    else:
+        meta = np.array(state[20:], dtype=np.uint8)
+    return bb, meta
+
+
+@njit(cache=True)
+def is_line(bits):
+    # checks if the 3x3 bitmask contains a complete row, column or diagonal
+    for w in WINS:
+        if bits & w == w:
+            return True
+    return False
+
+
+@njit(cache=True)
+def legal_mask(bb, meta, out):
+    """ Writes the encoded legal actions of the state into out.
+
+    Args:
+        bb:     The sub-board and big board bitmasks.
+        meta:   The sub-board constraint and the player to move.
+        out:    An array with room for at least 81 actions.
+
+    Returns:    The number of legal actions written
+
+    """
+    finished = bb[18] | bb[19]
+    if meta[0] == UNCONSTRAINED:
+        first, last = 0, 9
+    else:
+        first = 3 * meta[0] + meta[1]
+        last = first + 1
+
+    n = 0
+    for board in range(first, last):
+        if finished & (1 << board):
+            continue
+        occupied = bb[2 * board] | bb[2 * board + 1]
+        for cell in range(9):
+            if not occupied & (1 << cell):
+                out[n] = 9 * board + cell
+                n += 1
+    return n
+
+
+@njit(cache=True)
+def next_bb(bb, meta, action):
+    """ Applies the encoded action to the state in place, following the rules of p2_t3.Board.next_state.
+
+    Args:
+        bb:     The sub-board and big board bitmasks.
+        meta:   The sub-board constraint and the player to move.
+        action: The encoded action.
+
+    """
+    board, cell = action // 9, action % 9
+    player_index = meta[2] - 1
+    board_bit = np.uint32(1 << board)
+
+    bb[2 * board + player_index] |= np.uint32(1 << cell)
+    if is_line(bb[2 * board + player_index]):
+        bb[18 + player_index] |= board_bit
+    elif bb[2 * board] | bb[2 * board + 1] == 0x1ff:
+        bb[18] |= board_bit
+        bb[19] |= board_bit
+
+    if (bb[18] | bb[19]) & (1 << cell):
+        meta[0], meta[1] = UNCONSTRAINED, UNCONSTRAINED
+    else:
+        meta[0], meta[1] = cell // 3, cell % 3
+    meta[2] = 3 - meta[2]
+
+
+@njit(cache=True)
+def winner(bb):
+    # returns the player who won the big board, 0 for a tie and -1 if the game is not over
+    p1 = bb[18] & ~bb[19]
+    p2 = bb[19] & ~bb[18]
+    if is_line(p1):
+        return 1
+    if is_line(p2):
+        return 2
+    if bb[18] | bb[19] == 0x1ff:
+        return 0
+    return -1
+
+
+@njit(cache=True, nogil=True)
+def rollout_jit(bb, meta):
+    """ Plays random legal actions from the state until the game ends, updating bb and meta in place.
+
+    Args:
+        bb:     The sub-board and big board bitmasks.
+        meta:   The sub-board constraint and the player to move.
+
+    Returns:    The winning player, or 0 for a tie
+
+    """
+    # Runs without the GIL so that leaf-parallel rollouts in threads execute concurrently.
+    legal = np.empty(81, dtype=np.int64)
+    result = winner(bb)
+    while result == -1:
+        n = legal_mask(bb, meta, legal)
+        if n == 0:
+            break
+        next_bb(bb, meta, legal[np.random.randint(0, n)])
+        result = winner(bb)
+    return result
+
+
+def empty_reply_table():
+    """ Creates the last good reply table used by rollout_lgr_jit.
+
+    Returns:    An array indexed by [player who played an action - 1, encoded action] holding the encoded reply that
+                last won a playout for the other player, or -1 if there is none
+
+    """
+    return np.full((2, 81), -1, dtype=np.int64)
+
+
+@njit(cache=True)
+def count_bits(bits):
+    bits = np.int64(bits)
+    n = 0
+    while bits:
+        bits &= bits - 1
+        n += 1
+    return n
+
+
+@njit(cache=True)
+def heuristic_winner(bb):
+    """ Estimates the winner of a non-terminal state, following mcts_modified.heuristic_eval: a player scores three
+    points for every sub-board they won, six more for every line of the big board where they won two sub-boards and
+    the third is still open, and one for every line of an open sub-board where they hold two cells and the third is
+    empty.
+
+    Args:
+        bb:     The sub-board and big board bitmasks.
+
+    Returns:    The player with the higher score, or 0 if the scores are equal
+
+    """
+    finished = bb[18] | bb[19]
+    scores = np.zeros(2, dtype=np.int64)
+    for player_index in range(2):
+        owned = bb[18 + player_index] & ~bb[19 - player_index]
+        score = 3 * count_bits(owned)
+        for w in WINS:
+            if count_bits(owned & w) == 2 and not finished & w & ~owned:
+                score += 6
+        for board in range(9):
+            if finished & (1 << board):
+                continue
+            cells = bb[2 * board + player_index]
+            empty = ~(bb[2 * board] | bb[2 * board + 1])
+            for w in WINS:
+                if count_bits(cells & w) == 2 and empty & w & ~cells:
+                    score += 1
+        scores[player_index] = score
+    if scores[0] > scores[1]:
+        return 1
+    if scores[1] > scores[0]:
+        return 2
+    return 0
+
+
+@njit(cache=True, nogil=True)
+def rollout_lgr_jit(bb, meta, replies, bot_identity, max_depth):
+    """ Plays out the state with the last good reply policy of mcts_modified.rollout, updating bb and meta in place:
+    the recorded reply to the previous action is played whenever it is legal, otherwise a random legal action.
+    After max_depth actions the winner is estimated with heuristic_winner. The replies of the player credited with
+    the playout (the bot if it won, otherwise the opponent) are recorded in replies, unless a truncated playout is
+    undecided.
+
+    Args:
+        bb:     The sub-board and big board bitmasks.
+        meta:   The sub-board constraint and the player to move.
+        replies:    The last good reply table, see empty_reply_table.
+        bot_identity:   The bot's identity, either 1 or 2
+        max_depth:  The maximum number of actions to play out.
+
+    Returns:    1.0 if the bot won (or is estimated to win), 0.0 if it lost or tied, 0.5 if undecided
+
+    """
+    legal = np.empty(81, dtype=np.int64)
+    actions = np.empty(max_depth, dtype=np.int64)
+    players = np.empty(max_depth, dtype=np.int64)
+    n_actions = 0
+
+    result = winner(bb)
+    while result == -1 and n_actions < max_depth:
+        n = legal_mask(bb, meta, legal)
+        if n == 0:
+            break
+        player = np.int64(meta[2])
+
+        action = -1
+        if n_actions > 0:
+            reply = replies[2 - player, actions[n_actions - 1]]
+            for i in range(n):
+                if legal[i] == reply:
+                    action = reply
+                    break
+        if action == -1:
+            action = legal[np.random.randint(0, n)]
+
+        next_bb(bb, meta, action)
+        actions[n_actions] = action
+        players[n_actions] = player
+        n_actions += 1
+        result = winner(bb)
+
+    if result == -1:
+        result = heuristic_winner(bb)
+        if result == 0:
+            return 0.5
+
+    winning_player = bot_identity if result == bot_identity else 3 - bot_identity
+    for i in range(1, n_actions):
+        if players[i] == winning_player:
+            replies[players[i - 1] - 1, actions[i - 1]] = actions[i]
+    return 1.0 if result == bot_identity else 0.0
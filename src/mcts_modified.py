@@ -1,12 +1,36 @@
 from mcts_node import MCTSNode
 from p2_t3 import Board
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from contextlib import nullcontext
+from threading import Lock
 import random
 import math
+import os
+
+try:
+    from fast_rollout import to_bitboards, empty_reply_table, rollout_lgr_jit
+except ImportError:  # numba is optional, fall back to playing out through the Board API
+    rollout_lgr_jit = None
 
 num_nodes = 900
 explore_faction = 2.
+num_processes = 1  # Independent trees searched in parallel by think (root parallelization), each in a new process
+rollouts_per_leaf = 1  # Rollouts run concurrently from each expanded leaf (leaf parallelization)
+num_threads = 1  # Threads growing the same tree in search (tree parallelization)
+virtual_loss = 1  # Games counted as lost along a path while a thread's rollout from it is in flight
+use_transpositions = True  # Share one node between all paths reaching the same state (single-threaded trees)
+# Actions played out before a rollout is scored with heuristic_eval. Cutting the slow Board API playouts short lets
+# many more games be sampled in the same time, while the compiled ones are cheap enough to play to the end.
+rollout_depth = 81 if rollout_lgr_jit is not None else 12
+
+_worker_args = None
+
+# Bound once for the rollouts; drawing 16 bits and taking the remainder is much cheaper than random.choice and the
+# bias over at most 81 legal actions is negligible
+_randbits = random.getrandbits
 
-last_good_replies = {}
 
 def traverse_nodes(node: MCTSNode, board: Board, state, bot_identity: int):
     """ Traverses the tree until the end criterion are met.
@@ -24,125 +48,156 @@ def traverse_nodes(node: MCTSNode, board: Board, state, bot_identity: int):
         state: The state associated with that node
 
     """
-    if len(node.untried_actions) > 0:
-        return node, state
-
-    best_node = (0, None)
-    for c_node in node.child_nodes.values():
+    while len(node.untried_actions) == 0 and len(node.child_nodes) > 0:
         opponent = (board.current_player(state) != bot_identity)
-        val = ucb(c_node, opponent)
-        if val >= best_node[0]:
-            best_node = (val, c_node)
-
-    if best_node[1] is not None:
-        best_state = board.next_state(state, best_node[1].parent_action)
-        return traverse_nodes(best_node[1], board, best_state, bot_identity)
+        child = select_child(node, opponent)
+        if child.parent is not node:
+            # A transposition last reached through another parent: point it back along the path taken now, which is
+            # the one backpropagation follows
+            child.parent_action = next(action for action, c_node in node.child_nodes.items() if c_node is child)
+            child.parent = node
+        node = child
+        state = board.next_state(state, node.parent_action)
 
     return node, state
 
 
-def expand_leaf(node: MCTSNode, board: Board, state):
+def expand_leaf(node: MCTSNode, board: Board, state, transpositions: dict | None = None, is_ended=None):
     """ Adds a new leaf to the tree by creating a new child node for the given node (if it is non-terminal).
+    With a transposition table, a state that is already in the tree is linked as the child instead, so that its
+    statistics are shared by every path reaching it.
 
     Args:
         node:   The node for which a child will be added.
         board:  The game setup.
         state:  The state of the game.
+        transpositions: State -> node table of the tree, if transpositions are shared.
+        is_ended:   A memoized board.is_ended to use instead of the board's.
 
     Returns:
         node: The added child node
         state: The state associated with that node
 
     """
-    if not board.is_ended(state) and len(node.untried_actions) > 0:
-        new_action = random.choice(node.untried_actions)
-        node.untried_actions.remove(new_action)
+    if is_ended is None:
+        is_ended = board.is_ended
+
+    if not is_ended(state) and len(node.untried_actions) > 0:
+        # Swap the picked action with the last one so it can be popped in constant time
+        untried_actions = node.untried_actions
+        i = random.randrange(len(untried_actions))
+        new_action = untried_actions[i]
+        untried_actions[i] = untried_actions[-1]
+        untried_actions.pop()
         new_state = board.next_state(state, new_action)
-        new_legal_actions = board.legal_actions(new_state)
-        new_node = MCTSNode(node, new_action, new_legal_actions)
-        node.child_nodes.update({new_action: new_node})
+        new_node = transpositions.get(new_state) if transpositions is not None else None
+        if new_node is None:
+            new_legal_actions = board.legal_actions(new_state)
+            new_node = MCTSNode(node, new_action, new_legal_actions)
+            if transpositions is not None:
+                transpositions[new_state] = new_node
+        else:
+            new_node.parent = node
+            new_node.parent_action = new_action
+        node.child_nodes[new_action] = new_node
     else:
         return node, state
     return new_node, new_state
 
 
-def rollout(board: Board, state, bot_identity: int):
+def rollout(board: Board, state, bot_identity: int, last_good_replies, max_depth: int = 81):
     """ Given the state of the game, the rollout plays out the remainder randomly.
+    Whenever the last good reply to the previous action is legal it is played instead of a random action, and the
+    replies of the winner are recorded in last_good_replies.
+    Playouts can be cut off after max_depth actions, in which case the outcome is estimated with heuristic_eval; an
+    undecided estimate counts as half a win and teaches no replies.
 
     Args:
         board:  The game setup.
         state:  The state of the game.
         bot_identity: Integer representing the bot's identity (1 or 2).
+        last_good_replies:  (action, player who played it) -> the reply that last won a playout for the other player,
+                            or the array from fast_rollout.empty_reply_table when numba is available.
+        max_depth:  The maximum number of actions to play out; 81 always plays to the end.
 
-    Returns:
-        state: The terminal game state
+    Returns:    1 if the bot won (or is estimated to win) the game, 0 if it lost or tied, 0.5 if undecided
 
     """
+    if rollout_lgr_jit is not None:
+        bb, meta = to_bitboards(state)
+        return rollout_lgr_jit(bb, meta, last_good_replies, bot_identity, max_depth)
+
     action_used = []
     prev_action = None
-    while not board.is_ended(state):
-        if prev_action is not None and prev_action in last_good_replies:
-            new_action = last_good_replies[prev_action]
-            if new_action not in board.legal_actions(state):
-                new_action = random.choice(board.legal_actions(state))
-        else:
-            new_action = random.choice(board.legal_actions(state))
+    for _ in range(max_depth):
+        if board.is_ended(state):
+            break
+        legal = board.legal_actions(state)
+        player = board.current_player(state)
+        new_action = last_good_replies.get((prev_action, 3 - player))
+        if new_action not in legal:
+            new_action = legal[_randbits(16) % len(legal)]
         next_state = board.next_state(state, new_action)
         if next_state is None:
             break
         state = next_state
-        action_used.append((new_action, board.current_player(state)))
+        action_used.append((new_action, player))
         prev_action = new_action
 
-    we_won = is_win(board, state, bot_identity)
-    winning_bot = bot_identity if we_won else bot_identity + 1
-    winning_bot = winning_bot if winning_bot <= 2 else 1
+    if board.is_ended(state):
+        result = 1 if is_win(board, state, bot_identity) else 0
+    else:
+        result = heuristic_eval(board, state, bot_identity)
+        if result == 0.5:
+            return result
 
-    while len(action_used) != 0:
-        curr_action = action_used.pop()
-        if curr_action[1] != winning_bot:
-            continue
-        if len(action_used) == 0:
-            break
-        preceding_action = action_used.pop()
-        last_good_replies[preceding_action[0]] = curr_action[0]
+    winning_bot = bot_identity if result == 1 else 3 - bot_identity
+    for preceding_action, (curr_action, curr_player) in zip(action_used, action_used[1:]):
+        if curr_player == winning_bot:
+            last_good_replies[preceding_action] = curr_action
 
-    return state, we_won
+    return result
 
 
 
-def backpropagate(node: MCTSNode | None, won: bool):
+def backpropagate(node: MCTSNode | None, wins_delta: float, visits_delta: int):
     """ Navigates the tree from a leaf node to the root, updating the win and visit count of each node along the path.
 
     Args:
         node:   A leaf node.
-        won:    An indicator of whether the bot won or lost the game.
+        wins_delta:     The number of simulated games from the leaf that the bot won, undecided ones counting half.
+        visits_delta:   The number of simulated games from the leaf.
 
     """
     while node is not None:
-        if won:
-            node.wins += 1
-        node.visits += 1
+        node.wins += wins_delta
+        node.visits += visits_delta
         node = node.parent
     return
 
 
-def ucb(node: MCTSNode, is_opponent: bool):
-    """ Calculates the UCB value for the given node from the perspective of the bot
+def select_child(node: MCTSNode, is_opponent: bool):
+    """ Selects the child with the highest UCB value from the perspective of the bot, evaluating all children of the
+    node in a single pass so that log(parent visits) is computed once rather than once per child. A child that has
+    no visits yet, which another thread has just expanded, is picked first.
 
     Args:
-        node:   A node.
+        node:   A node with at least one child.
         is_opponent: A boolean indicating whether or not the last action was performed by the MCTS bot
     Returns:
-        The value of the UCB function for the given node
+        The child node with the highest UCB value
     """
-    ucb_val = node.wins / node.visits
-    if is_opponent:
-        ucb_val = 1 - ucb_val
-
-    ucb_val += explore_faction * math.sqrt(math.log(node.parent.visits) / node.visits)
+    for c_node in node.child_nodes.values():
+        if c_node.visits == 0:
+            return c_node
 
-    return ucb_val
+    log_visits = math.log(node.visits)
+    sqrt = math.sqrt
+    # The opponent picks by its own win rate, 1 - wins / visits
+    offset, sign = (1, -1) if is_opponent else (0, 1)
+    return max(node.child_nodes.values(),
+               key=lambda c_node: offset + sign * c_node.wins / c_node.visits
+               + explore_faction * sqrt(log_visits / c_node.visits))
 
 
 def get_best_action(root_node: MCTSNode):
@@ -154,13 +209,10 @@ def get_best_action(root_node: MCTSNode):
         action: The best action from the root node
 
     """
-    best_pick = (0, None)
-    for c_node in root_node.child_nodes.values():
-        val = c_node.wins / c_node.visits
-        if val >= best_pick[0]:
-            best_pick = (val, c_node)
-
-    return best_pick[1].parent_action
+    best_pick = max(root_node.child_nodes.values(), key=lambda c_node: c_node.wins / c_node.visits, default=None)
+    if best_pick is None:
+        return None
+    return best_pick.parent_action
 
 
 def is_win(board: Board, state, identity_of_bot: int):
@@ -170,8 +222,183 @@ def is_win(board: Board, state, identity_of_bot: int):
     return outcome[identity_of_bot] == 1
 
 
+def heuristic_eval(board: Board, state, identity_of_bot: int):
+    """ Estimates whether the bot is winning a non-terminal state. A player scores three points for every sub-board
+    they won, six more for every line of the big board where they won two sub-boards and the third is still open, and
+    one for every line of an open sub-board where they hold two cells and the third is empty.
+
+    Args:
+        board:  The game setup.
+        state:  The state of the game.
+        identity_of_bot:    The bot's identity, either 1 or 2
+
+    Returns:    1 if the bot scores higher than the opponent, 0 if lower and 0.5 if the scores are equal
+
+    """
+    finished = state[18] | state[19]
+    scores = {}
+    for player, owned in ((1, state[18] & ~state[19]), (2, state[19] & ~state[18])):
+        score = 3 * owned.bit_count()
+        for w in board.wins:
+            if (owned & w).bit_count() == 2 and not finished & w & ~owned:
+                score += 6
+        for sub_board in range(9):
+            if finished & (1 << sub_board):
+                continue
+            cells = state[2 * sub_board + player - 1]
+            empty = ~(state[2 * sub_board] | state[2 * sub_board + 1])
+            for w in board.wins:
+                if (cells & w).bit_count() == 2 and empty & w & ~cells:
+                    score += 1
+        scores[player] = score
+    if scores[identity_of_bot] == scores[3 - identity_of_bot]:
+        return 0.5
+    return 1 if scores[identity_of_bot] > scores[3 - identity_of_bot] else 0
+
+
+def search(board: Board, current_state, bot_identity: int, iterations: int):
+    """ Builds an MCTS tree rooted at the current state by sampling the given number of games.
+
+    Args:
+        board:  The game setup.
+        current_state:  The current state of the game.
+        bot_identity:   The bot's identity, either 1 or 2
+        iterations: The number of games to sample.
+
+    Returns:    The root node of the tree
+
+    """
+    is_ended = lru_cache(1 << 16)(board.is_ended)  # Memoized for this move only
+    root_node = MCTSNode(parent=None, parent_action=None, action_list=board.legal_actions(current_state))
+    last_good_replies = empty_reply_table() if rollout_lgr_jit is not None else {}
+
+    # Re-pointing a shared node's parent would let concurrent threads backpropagate along each other's paths
+    transpositions = {} if use_transpositions and num_threads == 1 else None
+
+    if num_threads > 1:
+        tree_lock = Lock()
+        counts = [iterations // num_threads + (i < iterations % num_threads) for i in range(num_threads)]
+        with ThreadPoolExecutor(num_threads) as workers:
+            futures = [workers.submit(grow_tree, root_node, board, current_state, bot_identity, n, last_good_replies,
+                                      is_ended=is_ended, tree_lock=tree_lock)
+                       for n in counts]
+        for future in futures:
+            future.result()  # Re-raises an exception from a worker thread here
+    else:
+        grow_tree(root_node, board, current_state, bot_identity, iterations, last_good_replies,
+                  transpositions=transpositions, is_ended=is_ended)
+
+    return root_node
+
+
+def grow_tree(root_node: MCTSNode, board: Board, current_state, bot_identity: int, iterations: int,
+              last_good_replies, transpositions: dict | None = None, is_ended=None, tree_lock=None):
+    """ Samples games from the current state and adds them to the tree under the root node.
+    When a tree lock is given, several threads may grow the same tree: selection, expansion and backpropagation
+    hold the lock, and the selected path carries a virtual loss while its rollouts run so that the other threads
+    are steered towards different paths.
+
+    Args:
+        root_node:  The root node of the tree.
+        board:  The game setup.
+        current_state:  The state of the game at the root node.
+        bot_identity:   The bot's identity, either 1 or 2
+        iterations: The number of games to sample.
+        last_good_replies:  The last good reply table shared by the rollouts of this search, a dict or the array
+                            from fast_rollout.empty_reply_table (see rollout).
+        transpositions: State -> node table of the tree, if transpositions are shared.
+        is_ended:   A memoized board.is_ended shared by the expansions of this search.
+        tree_lock:  The lock shared by the threads growing the tree, if there are several.
+
+    """
+    lock = tree_lock if tree_lock is not None else nullcontext()
+    loss = virtual_loss if tree_lock is not None else 0
+
+    with ThreadPoolExecutor(rollouts_per_leaf) as pool:
+        for _ in range(iterations):
+            state = current_state
+            node = root_node
+            # Do MCTS - This is all you!
+            # ...
+            with lock:
+                node, state = traverse_nodes(node, board, state, bot_identity)
+                node, state = expand_leaf(node, board, state, transpositions, is_ended)
+                if loss:
+                    add_virtual_loss(node, loss)
+
+            if rollouts_per_leaf > 1:
+                results = list(pool.map(
+                    lambda _: rollout(board, state, bot_identity, last_good_replies, rollout_depth),
+                    range(rollouts_per_leaf)))
+            else:
+                results = [rollout(board, state, bot_identity, last_good_replies, rollout_depth)]
+            wins = sum(results)
+            with lock:
+                if loss:
+                    add_virtual_loss(node, -loss)
+                backpropagate(node, wins, len(results))
+
+
+def add_virtual_loss(node: MCTSNode, amount: int):
+    """ Adds virtual games to every node on the path from the given node to the root, counted as lost by the player
+    who chooses that node. A negative amount removes them again.
+
+    Args:
+        node:   A leaf node.
+        amount: The number of virtual games to add.
+
+    """
+    path = []
+    while node is not None:
+        path.append(node)
+        node = node.parent
+
+    # The bot chooses among the root's children, the opponent at the next level, and so on. Wins are counted for the
+    # bot, so a loss for the opponent is a win.
+    for depth, p_node in enumerate(reversed(path)):
+        p_node.visits += amount
+        if depth > 0 and depth % 2 == 0:
+            p_node.wins += amount
+
+
+def _worker_init(board: Board, current_state, bot_identity: int, seed: int):
+    # stores the search setup in a worker process and seeds it so the workers' rollouts diverge
+    global _worker_args
+    _worker_args = (board, current_state, bot_identity)
+    random.seed(os.getpid() ^ seed)
+
+
+def _worker_search(iterations: int):
+    # builds an independent tree in a worker process and returns its root children as action -> (wins, visits)
+    root_node = search(*_worker_args, iterations)
+    return {action: (c_node.wins, c_node.visits) for action, c_node in root_node.child_nodes.items()}
+
+
+def merge_roots(root_stats: list):
+    """ Merges the root statistics of independently searched trees into a single root node.
+
+    Args:
+        root_stats: A list of action -> (wins, visits) dictionaries, one per tree.
+
+    Returns:    A root node whose children hold the summed wins and visits of each action
+
+    """
+    root_node = MCTSNode(parent=None, parent_action=None, action_list=[])
+    for stats in root_stats:
+        for action, (wins, visits) in stats.items():
+            if action not in root_node.child_nodes:
+                root_node.child_nodes[action] = MCTSNode(root_node, action, [])
+            c_node = root_node.child_nodes[action]
+            c_node.wins += wins
+            c_node.visits += visits
+            root_node.visits += visits
+    return root_node
+
+
 def think(board: Board, current_state):
     """ Performs MCTS by sampling games and calling the appropriate functions to construct the game tree.
+    When num_processes > 1 the games are split across worker processes, each building its own tree, and the
+    root statistics of the trees are merged before picking the action.
 
     Args:
         board:  The game setup.
@@ -181,18 +408,14 @@ def think(board: Board, current_state):
 
     """
     bot_identity = board.current_player(current_state)  # 1 or 2
-    root_node = MCTSNode(parent=None, parent_action=None, action_list=board.legal_actions(current_state))
 
-    for _ in range(num_nodes):
-        state = current_state
-        node = root_node
-        # Do MCTS - This is all you!
-        # ...
-        node, state = traverse_nodes(node, board, state, bot_identity)
-        node, state = expand_leaf(node, board, state)
-
-        rollout_state, win = rollout(board, state, bot_identity)
-        backpropagate(node, win)
+    if num_processes > 1:
+        iterations = [num_nodes // num_processes + (i < num_nodes % num_processes) for i in range(num_processes)]
+        seed = random.getrandbits(32)
+        with Pool(num_processes, _worker_init, (board, current_state, bot_identity, seed)) as pool:
+            root_node = merge_roots(pool.map(_worker_search, iterations))
+    else:
+        root_node = search(board, current_state, bot_identity, num_nodes)
 
     # Return an action, typically the most frequently used action (from the root) or the action with the best
     # estimated win rate.
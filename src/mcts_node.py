@@ -1,6 +1,9 @@
 
 
 class MCTSNode:
+    # Nodes are created for every expansion, so they store their fields in slots rather than a per-instance __dict__
+    __slots__ = ('parent', 'parent_action', 'child_nodes', 'untried_actions', 'wins', 'visits')
+
     def __init__(self, parent=None, parent_action=None, action_list=[]):
         """ Initializes the tree node for MCTS. The node stores links to other nodes in the tree (parent and child
         nodes), as well as keeps track of the number of wins and total simulations that have visited the node.
@@ -8,7 +11,8 @@ class MCTSNode:
         Args:
             parent:         The parent node of this node.
             parent_action:  The action taken from the parent node that transitions the state to this node.
-            action_list:    The list of legal actions to be considered at this node.
+            action_list:    The list of legal actions to be considered at this node. The node consumes it as
+                            actions are tried, so it must not be shared.
 
         """
         self.parent = parent                    # Parent node to this node
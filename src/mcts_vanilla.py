@@ -1,10 +1,32 @@
 from mcts_node import MCTSNode
 from p2_t3 import Board
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from contextlib import nullcontext
+from threading import Lock
 import random
 import math
+import os
+
+try:
+    from fast_rollout import to_bitboards, rollout_jit
+except ImportError:  # numba is optional, fall back to playing out through the Board API
+    rollout_jit = None
 
 num_nodes = 900
 explore_faction = 2.
+num_processes = 1  # Independent trees searched in parallel by think (root parallelization), each in a new process
+rollouts_per_leaf = 1  # Rollouts run concurrently from each expanded leaf (leaf parallelization)
+num_threads = 1  # Threads growing the same tree in search (tree parallelization)
+virtual_loss = 1  # Games counted as lost along a path while a thread's rollout from it is in flight
+use_transpositions = True  # Share one node between all paths reaching the same state (single-threaded trees)
+
+_worker_args = None
+
+# Bound once for the rollouts; drawing 16 bits and taking the remainder is much cheaper than random.choice and the
+# bias over at most 81 legal actions is negligible
+_randbits = random.getrandbits
 
 def traverse_nodes(node: MCTSNode, board: Board, state, bot_identity: int):
     """ Traverses the tree until the end criterion are met.
@@ -22,100 +44,127 @@ def traverse_nodes(node: MCTSNode, board: Board, state, bot_identity: int):
         state: The state associated with that node
 
     """
-    if len(node.untried_actions) > 0:
-        return node, state
-
-    best_node = (0, None)
-    for c_node in node.child_nodes.values():
+    while len(node.untried_actions) == 0 and len(node.child_nodes) > 0:
         opponent = (board.current_player(state) != bot_identity)
-        val = ucb(c_node, opponent)
-        if val >= best_node[0]:
-            best_node = (val, c_node)
-
-    if best_node[1] is not None:
-        best_state = board.next_state(state, best_node[1].parent_action)
-        return traverse_nodes(best_node[1], board, best_state, bot_identity)
+        child = select_child(node, opponent)
+        if child.parent is not node:
+            # A transposition last reached through another parent: point it back along the path taken now, which is
+            # the one backpropagation follows
+            child.parent_action = next(action for action, c_node in node.child_nodes.items() if c_node is child)
+            child.parent = node
+        node = child
+        state = board.next_state(state, node.parent_action)
 
     return node, state
 
 
-def expand_leaf(node: MCTSNode, board: Board, state):
+def expand_leaf(node: MCTSNode, board: Board, state, transpositions: dict | None = None, is_ended=None):
     """ Adds a new leaf to the tree by creating a new child node for the given node (if it is non-terminal).
+    With a transposition table, a state that is already in the tree is linked as the child instead, so that its
+    statistics are shared by every path reaching it.
 
     Args:
         node:   The node for which a child will be added.
         board:  The game setup.
         state:  The state of the game.
+        transpositions: State -> node table of the tree, if transpositions are shared.
+        is_ended:   A memoized board.is_ended to use instead of the board's.
 
     Returns:
         node: The added child node
         state: The state associated with that node
 
     """
-    if not board.is_ended(state) and len(node.untried_actions) > 0:
-        new_action = random.choice(node.untried_actions)
-        node.untried_actions.remove(new_action)
+    if is_ended is None:
+        is_ended = board.is_ended
+
+    if not is_ended(state) and len(node.untried_actions) > 0:
+        # Swap the picked action with the last one so it can be popped in constant time
+        untried_actions = node.untried_actions
+        i = random.randrange(len(untried_actions))
+        new_action = untried_actions[i]
+        untried_actions[i] = untried_actions[-1]
+        untried_actions.pop()
         new_state = board.next_state(state, new_action)
-        new_legal_actions = board.legal_actions(new_state)
-        new_node = MCTSNode(node, new_action, new_legal_actions)
-        node.child_nodes.update({new_action: new_node})
+        new_node = transpositions.get(new_state) if transpositions is not None else None
+        if new_node is None:
+            new_legal_actions = board.legal_actions(new_state)
+            new_node = MCTSNode(node, new_action, new_legal_actions)
+            if transpositions is not None:
+                transpositions[new_state] = new_node
+        else:
+            new_node.parent = node
+            new_node.parent_action = new_action
+        node.child_nodes[new_action] = new_node
     else:
         return node, state
     return new_node, new_state
 
 
-def rollout(board: Board, state):
+def rollout(board: Board, state, bot_identity: int):
     """ Given the state of the game, the rollout plays out the remainder randomly.
 
     Args:
         board:  The game setup.
         state:  The state of the game.
-    
-    Returns:
-        state: The terminal game state
+        bot_identity: Integer representing the bot's identity (1 or 2).
+
+    Returns:    Whether the bot won the game
 
     """
+    if rollout_jit is not None:
+        bb, meta = to_bitboards(state)
+        return rollout_jit(bb, meta) == bot_identity
+
     while not board.is_ended(state):
-        new_action = random.choice(board.legal_actions(state))
+        legal = board.legal_actions(state)
+        new_action = legal[_randbits(16) % len(legal)]
         next_state = board.next_state(state, new_action)
         if next_state is None:
             break
         state = next_state
-    return state
+    return is_win(board, state, bot_identity)
 
 
-def backpropagate(node: MCTSNode|None, won: bool):
+def backpropagate(node: MCTSNode|None, wins_delta: int, visits_delta: int):
     """ Navigates the tree from a leaf node to the root, updating the win and visit count of each node along the path.
 
     Args:
         node:   A leaf node.
-        won:    An indicator of whether the bot won or lost the game.
+        wins_delta:     The number of simulated games from the leaf that the bot won.
+        visits_delta:   The number of simulated games from the leaf.
 
     """
     while node is not None:
-        if won:
-            node.wins += 1
-        node.visits += 1
+        node.wins += wins_delta
+        node.visits += visits_delta
         node = node.parent
     return
 
 
-def ucb(node: MCTSNode, is_opponent: bool):
-    """ Calculates the UCB value for the given node from the perspective of the bot
+def select_child(node: MCTSNode, is_opponent: bool):
+    """ Selects the child with the highest UCB value from the perspective of the bot, evaluating all children of the
+    node in a single pass so that log(parent visits) is computed once rather than once per child. A child that has
+    no visits yet, which another thread has just expanded, is picked first.
 
     Args:
-        node:   A node.
+        node:   A node with at least one child.
         is_opponent: A boolean indicating whether or not the last action was performed by the MCTS bot
     Returns:
-        The value of the UCB function for the given node
+        The child node with the highest UCB value
     """
-    ucb_val = node.wins / node.visits
-    if is_opponent:
-        ucb_val = 1 - ucb_val
+    for c_node in node.child_nodes.values():
+        if c_node.visits == 0:
+            return c_node
 
-    ucb_val += explore_faction * math.sqrt(math.log(node.parent.visits)/node.visits)
+    log_visits = math.log(node.visits)
+    sqrt = math.sqrt
+    # The opponent picks by its own win rate, 1 - wins / visits
+    offset, sign = (1, -1) if is_opponent else (0, 1)
+    return max(node.child_nodes.values(),
+               key=lambda c_node: offset + sign * c_node.wins / c_node.visits
+               + explore_faction * sqrt(log_visits / c_node.visits))
 
-    return ucb_val
 
 def get_best_action(root_node: MCTSNode):
     """ Selects the best action from the root node in the MCTS tree
@@ -126,13 +175,10 @@ def get_best_action(root_node: MCTSNode):
         action: The best action from the root node
     
     """
-    best_pick = (0, None)
-    for c_node in root_node.child_nodes.values():
-        val = c_node.wins / c_node.visits
-        if val >= best_pick[0]:
-            best_pick = (val, c_node)
-
-    return best_pick[1].parent_action
+    best_pick = max(root_node.child_nodes.values(), key=lambda c_node: c_node.wins / c_node.visits, default=None)
+    if best_pick is None:
+        return None
+    return best_pick.parent_action
 
 
 def is_win(board: Board, state, identity_of_bot: int):
@@ -142,8 +188,144 @@ def is_win(board: Board, state, identity_of_bot: int):
     return outcome[identity_of_bot] == 1
 
 
+def search(board: Board, current_state, bot_identity: int, iterations: int):
+    """ Builds an MCTS tree rooted at the current state by sampling the given number of games.
+
+    Args:
+        board:  The game setup.
+        current_state:  The current state of the game.
+        bot_identity:   The bot's identity, either 1 or 2
+        iterations: The number of games to sample.
+
+    Returns:    The root node of the tree
+
+    """
+    is_ended = lru_cache(1 << 16)(board.is_ended)  # Memoized for this move only
+    root_node = MCTSNode(parent=None, parent_action=None, action_list=board.legal_actions(current_state))
+
+    # Re-pointing a shared node's parent would let concurrent threads backpropagate along each other's paths
+    transpositions = {} if use_transpositions and num_threads == 1 else None
+
+    if num_threads > 1:
+        tree_lock = Lock()
+        counts = [iterations // num_threads + (i < iterations % num_threads) for i in range(num_threads)]
+        with ThreadPoolExecutor(num_threads) as workers:
+            futures = [workers.submit(grow_tree, root_node, board, current_state, bot_identity, n,
+                                      is_ended=is_ended, tree_lock=tree_lock)
+                       for n in counts]
+        for future in futures:
+            future.result()  # Re-raises an exception from a worker thread here
+    else:
+        grow_tree(root_node, board, current_state, bot_identity, iterations,
+                  transpositions=transpositions, is_ended=is_ended)
+
+    return root_node
+
+
+def grow_tree(root_node: MCTSNode, board: Board, current_state, bot_identity: int, iterations: int,
+              transpositions: dict | None = None, is_ended=None, tree_lock=None):
+    """ Samples games from the current state and adds them to the tree under the root node.
+    When a tree lock is given, several threads may grow the same tree: selection, expansion and backpropagation
+    hold the lock, and the selected path carries a virtual loss while its rollouts run so that the other threads
+    are steered towards different paths.
+
+    Args:
+        root_node:  The root node of the tree.
+        board:  The game setup.
+        current_state:  The state of the game at the root node.
+        bot_identity:   The bot's identity, either 1 or 2
+        iterations: The number of games to sample.
+        transpositions: State -> node table of the tree, if transpositions are shared.
+        is_ended:   A memoized board.is_ended shared by the expansions of this search.
+        tree_lock:  The lock shared by the threads growing the tree, if there are several.
+
+    """
+    lock = tree_lock if tree_lock is not None else nullcontext()
+    loss = virtual_loss if tree_lock is not None else 0
+
+    with ThreadPoolExecutor(rollouts_per_leaf) as pool:
+        for _ in range(iterations):
+            state = current_state
+            node = root_node
+            # Do MCTS - This is all you!
+            # ...
+            with lock:
+                node, state = traverse_nodes(node, board, state, bot_identity)
+                node, state = expand_leaf(node, board, state, transpositions, is_ended)
+                if loss:
+                    add_virtual_loss(node, loss)
+
+            if rollouts_per_leaf > 1:
+                results = list(pool.map(lambda _: rollout(board, state, bot_identity), range(rollouts_per_leaf)))
+            else:
+                results = [rollout(board, state, bot_identity)]
+            wins = sum(results)
+            with lock:
+                if loss:
+                    add_virtual_loss(node, -loss)
+                backpropagate(node, wins, len(results))
+
+
+def add_virtual_loss(node: MCTSNode, amount: int):
+    """ Adds virtual games to every node on the path from the given node to the root, counted as lost by the player
+    who chooses that node. A negative amount removes them again.
+
+    Args:
+        node:   A leaf node.
+        amount: The number of virtual games to add.
+
+    """
+    path = []
+    while node is not None:
+        path.append(node)
+        node = node.parent
+
+    # The bot chooses among the root's children, the opponent at the next level, and so on. Wins are counted for the
+    # bot, so a loss for the opponent is a win.
+    for depth, p_node in enumerate(reversed(path)):
+        p_node.visits += amount
+        if depth > 0 and depth % 2 == 0:
+            p_node.wins += amount
+
+
+def _worker_init(board: Board, current_state, bot_identity: int, seed: int):
+    # stores the search setup in a worker process and seeds it so the workers' rollouts diverge
+    global _worker_args
+    _worker_args = (board, current_state, bot_identity)
+    random.seed(os.getpid() ^ seed)
+
+
+def _worker_search(iterations: int):
+    # builds an independent tree in a worker process and returns its root children as action -> (wins, visits)
+    root_node = search(*_worker_args, iterations)
+    return {action: (c_node.wins, c_node.visits) for action, c_node in root_node.child_nodes.items()}
+
+
+def merge_roots(root_stats: list):
+    """ Merges the root statistics of independently searched trees into a single root node.
+
+    Args:
+        root_stats: A list of action -> (wins, visits) dictionaries, one per tree.
+
+    Returns:    A root node whose children hold the summed wins and visits of each action
+
+    """
+    root_node = MCTSNode(parent=None, parent_action=None, action_list=[])
+    for stats in root_stats:
+        for action, (wins, visits) in stats.items():
+            if action not in root_node.child_nodes:
+                root_node.child_nodes[action] = MCTSNode(root_node, action, [])
+            c_node = root_node.child_nodes[action]
+            c_node.wins += wins
+            c_node.visits += visits
+            root_node.visits += visits
+    return root_node
+
+
 def think(board: Board, current_state):
     """ Performs MCTS by sampling games and calling the appropriate functions to construct the game tree.
+    When num_processes > 1 the games are split across worker processes, each building its own tree, and the
+    root statistics of the trees are merged before picking the action.
 
     Args:
         board:  The game setup.
@@ -153,19 +335,14 @@ def think(board: Board, current_state):
 
     """
     bot_identity = board.current_player(current_state) # 1 or 2
-    root_node = MCTSNode(parent=None, parent_action=None, action_list=board.legal_actions(current_state))
 
-    for _ in range(num_nodes):
-        state = current_state
-        node = root_node
-        # Do MCTS - This is all you!
-        # ...
-        node, state = traverse_nodes(node, board, state, bot_identity)
-        node, state = expand_leaf(node, board, state)
-
-        rollout_state = rollout(board, state)
-        win = is_win(board, rollout_state, bot_identity)
-        backpropagate(node, win)
+    if num_processes > 1:
+        iterations = [num_nodes // num_processes + (i < num_nodes % num_processes) for i in range(num_processes)]
+        seed = random.getrandbits(32)
+        with Pool(num_processes, _worker_init, (board, current_state, bot_identity, seed)) as pool:
+            root_node = merge_roots(pool.map(_worker_search, iterations))
+    else:
+        root_node = search(board, current_state, bot_identity, num_nodes)
 
     # Return an action, typically the most frequently used action (from the root) or the action with the best
     # estimated win rate.
@@ -24,33 +24,34 @@ players = dict(
     mcts_modified=mcts_modified.think,
 )
 
-board = p2_t3.Board()
-state0 = board.starting_state()
+if __name__ == '__main__':
+    board = p2_t3.Board()
+    state0 = board.starting_state()
 
-if len(sys.argv) != 3:
-    print("Need two player arguments")
-    exit(1)
+    if len(sys.argv) != 3:
+        print("Need two player arguments")
+        exit(1)
 
-p1 = sys.argv[1]
-if p1 not in players:
-    print("p1 not in "+", ".join(players.keys()))
-    exit(1)
-p2 = sys.argv[2]
-if p2 not in players:
-    print("p2 not in "+", ".join(players.keys()))
-    exit(1)
+    p1 = sys.argv[1]
+    if p1 not in players:
+        print("p1 not in "+", ".join(players.keys()))
+        exit(1)
+    p2 = sys.argv[2]
+    if p2 not in players:
+        print("p2 not in "+", ".join(players.keys()))
+        exit(1)
 
-player1 = players[p1]
-player2 = players[p2]
-state = state0
-last_action = None
-current_player = player1
-while not board.is_ended(state):
+    player1 = players[p1]
+    player2 = players[p2]
+    state = state0
+    last_action = None
+    current_player = player1
+    while not board.is_ended(state):
+        print(board.display(state, last_action))
+        print("Player "+str(board.current_player(state)))
+        last_action = current_player(board, state)
+        state = board.next_state(state, last_action)
+        current_player = player1 if current_player == player2 else player2
+    print("Finished!")
     print(board.display(state, last_action))
-    print("Player "+str(board.current_player(state)))
-    last_action = current_player(board, state)
-    state = board.next_state(state, last_action)
-    current_player = player1 if current_player == player2 else player2
-print("Finished!")
-print(board.display(state, last_action))
-print(board.points_values(state))
+    print(board.points_values(state))